@@ -19,8 +19,12 @@ upstream_dns_file: /path/to/adg.txt
 """
 
 import base64
+import os
 from pathlib import Path
+import queue
 import re
+import shutil
+import threading
 import traceback
 import urllib.request
 
@@ -37,6 +41,110 @@ BASE_DNS_SERVER = AliYun_DNS_SERVER
 # Use Google public DNS because it support ECS.
 DEFAULT_SECURE_DNS_SERVER = '8.8.8.8'
 
+# Seconds to wait for a gfwlist mirror to connect or send data.
+FETCH_TIMEOUT = 30
+
+# Google domains under each country code TLD.
+GOOGLE_TLDS = frozenset({
+    'google.com', 'google.ad', 'google.ae',
+    'google.com.af', 'google.com.ag', 'google.com.ai', 'google.al',
+    'google.am', 'google.co.ao', 'google.com.ar', 'google.as', 'google.at',
+    'google.com.au', 'google.az', 'google.ba', 'google.com.bd', 'google.be',
+    'google.bf', 'google.bg', 'google.com.bh', 'google.bi', 'google.bj',
+    'google.com.bn', 'google.com.bo', 'google.com.br', 'google.bs',
+    'google.bt', 'google.co.bw', 'google.by', 'google.com.bz', 'google.ca',
+    'google.cd', 'google.cf', 'google.cg', 'google.ch', 'google.ci',
+    'google.co.ck', 'google.cl', 'google.cm', 'google.cn', 'google.com.co',
+    'google.co.cr', 'google.com.cu', 'google.cv', 'google.com.cy',
+    'google.cz', 'google.de', 'google.dj', 'google.dk', 'google.dm',
+    'google.com.do', 'google.dz', 'google.com.ec', 'google.ee',
+    'google.com.eg', 'google.es', 'google.com.et', 'google.fi',
+    'google.com.fj', 'google.fm', 'google.fr', 'google.ga', 'google.ge',
+    'google.gg', 'google.com.gh', 'google.com.gi', 'google.gl', 'google.gm',
+    'google.gp', 'google.gr', 'google.com.gt', 'google.gy', 'google.com.hk',
+    'google.hn', 'google.hr', 'google.ht', 'google.hu', 'google.co.id',
+    'google.ie', 'google.co.il', 'google.im', 'google.co.in', 'google.iq',
+    'google.is', 'google.it', 'google.je', 'google.com.jm', 'google.jo',
+    'google.co.jp', 'google.co.ke', 'google.com.kh', 'google.ki',
+    'google.kg', 'google.co.kr', 'google.com.kw', 'google.kz', 'google.la',
+    'google.com.lb', 'google.li', 'google.lk', 'google.co.ls', 'google.lt',
+    'google.lu', 'google.lv', 'google.com.ly', 'google.co.ma', 'google.md',
+    'google.me', 'google.mg', 'google.mk', 'google.ml', 'google.com.mm',
+    'google.mn', 'google.ms', 'google.com.mt', 'google.mu', 'google.mv',
+    'google.mw', 'google.com.mx', 'google.com.my', 'google.co.mz',
+    'google.com.na', 'google.com.nf', 'google.com.ng', 'google.com.ni',
+    'google.ne', 'google.nl', 'google.no', 'google.com.np', 'google.nr',
+    'google.nu', 'google.co.nz', 'google.com.om', 'google.com.pa',
+    'google.com.pe', 'google.com.pg', 'google.com.ph', 'google.com.pk',
+    'google.pl', 'google.pn', 'google.com.pr', 'google.ps', 'google.pt',
+    'google.com.py', 'google.com.qa', 'google.ro', 'google.ru', 'google.rw',
+    'google.com.sa', 'google.com.sb', 'google.sc', 'google.se',
+    'google.com.sg', 'google.sh', 'google.si', 'google.sk', 'google.com.sl',
+    'google.sn', 'google.so', 'google.sm', 'google.sr', 'google.st',
+    'google.com.sv', 'google.td', 'google.tg', 'google.co.th',
+    'google.com.tj', 'google.tk', 'google.tl', 'google.tm', 'google.tn',
+    'google.to', 'google.com.tr', 'google.tt', 'google.com.tw',
+    'google.co.tz', 'google.com.ua', 'google.co.ug', 'google.co.uk',
+    'google.com.uy', 'google.co.uz', 'google.com.vc', 'google.co.ve',
+    'google.vg', 'google.co.vi', 'google.com.vn', 'google.vu', 'google.ws',
+    'google.rs', 'google.co.za', 'google.co.zm', 'google.co.zw',
+    'google.cat'
+})
+
+# Blogspot domains under each country code TLD.
+BLOGSPOT_TLDS = frozenset({
+    'blogspot.ca', 'blogspot.co.uk', 'blogspot.com',
+    'blogspot.com.ar', 'blogspot.com.au', 'blogspot.com.br',
+    'blogspot.com.by', 'blogspot.com.co', 'blogspot.com.cy',
+    'blogspot.com.ee', 'blogspot.com.eg', 'blogspot.com.es',
+    'blogspot.com.mt', 'blogspot.com.ng', 'blogspot.com.tr',
+    'blogspot.com.uy', 'blogspot.de', 'blogspot.gr', 'blogspot.in',
+    'blogspot.mx', 'blogspot.ch', 'blogspot.fr', 'blogspot.ie',
+    'blogspot.it', 'blogspot.pt', 'blogspot.ro', 'blogspot.sg',
+    'blogspot.be', 'blogspot.no', 'blogspot.se', 'blogspot.jp',
+    'blogspot.in', 'blogspot.ae', 'blogspot.al', 'blogspot.am',
+    'blogspot.ba', 'blogspot.bg', 'blogspot.ch', 'blogspot.cl',
+    'blogspot.cz', 'blogspot.dk', 'blogspot.fi', 'blogspot.gr',
+    'blogspot.hk', 'blogspot.hr', 'blogspot.hu', 'blogspot.ie',
+    'blogspot.is', 'blogspot.kr', 'blogspot.li', 'blogspot.lt',
+    'blogspot.lu', 'blogspot.md', 'blogspot.mk', 'blogspot.my',
+    'blogspot.nl', 'blogspot.no', 'blogspot.pe', 'blogspot.qa',
+    'blogspot.ro', 'blogspot.ru', 'blogspot.se', 'blogspot.sg',
+    'blogspot.si', 'blogspot.sk', 'blogspot.sn', 'blogspot.tw',
+    'blogspot.ug', 'blogspot.cat'
+})
+
+# Refer to https://github.com/cokebar/gfwlist2dnsmasq/blob/master/gfwlist2dnsmasq.sh
+# for a bash implementation which parses gfwlist and generates dnsmasq config.
+# This parser is based on the bash implementation.
+#
+# The whole gfwlist is scanned at once, each match yields the domain of a line.
+#
+# Ignore
+# 1. comments starting with '!'
+# 2. white list starting with @@
+# 3. lines starting with '[' or '/' (header and regex rules)
+# 4. urls with IPv4 address as host, also behind a wildcard part so that
+#    e.g. '*1.2.3.4' doesn't yield '2.3.4'
+#
+# Otherwise skip the starting || or |, the url protocol (http:// or https://)
+# and the wildcard part, and take the domain up to the trailing wildcard, the
+# path or query string.
+#
+# Ignored lines are rejected by their first bytes or by the host, the path
+# and query string of a line are never scanned.
+DOMAIN_LINE_RE = re.compile(
+    rb'(?m)^(?![!@\[/])'
+    rb'(?:\|\|?)?(?:https?://)?'
+    rb'(?![*.]*[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+'
+    rb'|[a-zA-Z0-9]*\*[-a-zA-Z0-9*.]*?[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+)'
+    rb'(?:(?:[a-zA-Z0-9]*\*[-a-zA-Z0-9]*)?\.)?'
+    rb'(?P<d>[a-zA-Z0-9][-a-zA-Z0-9]*(?:\.[a-zA-Z0-9][-a-zA-Z0-9]*)+)'
+    rb'(?=[*/\r\n]|%2F|$)')
+
+# Regex rules can't be converted to domains.
+REGEX_RULE_RE = re.compile(rb'(?m)^/[^\r\n]*')
+
 
 class GfwList:
     URLs = [
@@ -52,179 +160,146 @@ class GfwList:
         """
         :param dns_server: dns server to use for resolving domains in gfwlist
         """
-        self.domains = set()
+        # Domains are only collected and then written out once, so a list
+        # is enough. Duplicates are dropped when sorting for output.
+        self.domains = []
         self.dns_server = dns_server
 
     @staticmethod
-    def _fetch_url(url):
+    def _fetch_url(url, stop):
+        """
+        Return the base64 decoded gfwlist, or None if download fails or is
+        stopped by setting the stop event.
+        """
         try:
             print(f'downloding gfwlist from {url}')
-            with urllib.request.urlopen(url) as response:
-                data = response.read()
+            # Decode while downloading instead of keeping the whole base64
+            # content. Only whole 4 character groups can be decoded, the rest
+            # is carried over to the next block.
+            data = bytearray()
+            carry = b''
+            with urllib.request.urlopen(url, timeout=FETCH_TIMEOUT) as response:
+                while block := response.read(65536):
+                    if stop.is_set():
+                        return None
+                    block = carry + b''.join(block.split())
+                    end = len(block) - len(block) % 4
+                    data += base64.b64decode(block[:end], validate=True)
+                    carry = block[end:]
+            data += base64.b64decode(carry, validate=True)
+            # Make sure an error page that happens to be valid base64 isn't
+            # taken as gfwlist.
+            if not data.startswith(b'[AutoProxy'):
+                raise ValueError('downloaded data is not in AutoProxy format')
             return data
         except:
-            print(f'download {url} failed')
-            traceback.print_exc()
+            if not stop.is_set():
+                print(f'download {url} failed')
+                traceback.print_exc()
             return None
 
     def fetch(self):
+        # Download from all mirrors concurrently and use the first one that
+        # succeeds, so a slow or dead mirror doesn't delay the others. The
+        # other downloads stop at their next block once one succeeds, and as
+        # daemon threads they don't keep the script running.
+        stop = threading.Event()
+        results = queue.Queue()
         for url in self.URLs:
-            data = self._fetch_url(url)
+            threading.Thread(target=lambda url=url: results.put(self._fetch_url(url, stop)),
+                             daemon=True).start()
+        for _ in self.URLs:
+            data = results.get()
             if data:
+                stop.set()
                 return data
         print(f'fail to download gfwlist')
 
-    # Refer to https://github.com/cokebar/gfwlist2dnsmasq/blob/master/gfwlist2dnsmasq.sh
-    # for a bash implementation which parses gfwlist and generates dnsmasq config.
-    # This parser is based on the bash implementation.
-
-    # Ignore
-    # 1. comments starting with '!'
-    # 2. white list starting with @@
-    # 3. urls with IPv4 address
-    ignore_pattern = re.compile(r'^\!|\[|^@@|(https?://){0,1}[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+')
-
-    # Remove:
-    # 1. starting || or |
-    # 2. url protocol (http:// or https://)
-    head_filter_pattern = re.compile(r'^(\|\|?)?(https?://)?')
-
-    # Remove the path and query string from URL.
-    tail_filter_pattern = re.compile(r'/.*$|%2F.*$')
-
-    domain_pattern = re.compile(r'([a-zA-Z0-9][-a-zA-Z0-9]*(\.[a-zA-Z0-9][-a-zA-Z0-9]*)+)')
-    wildcard_pattern = re.compile(r'^(([a-zA-Z0-9]*\*[-a-zA-Z0-9]*)?(\.))?([a-zA-Z0-9][-a-zA-Z0-9]*(\.[a-zA-Z0-9][-a-zA-Z0-9]*)+)(\*[a-zA-Z0-9]*)?$')
-
-    def _parse_line(self, line):
-        is_regex_rule = False
-        origin_line = line
-        if line.startswith('/'):
-            is_regex_rule = True
-
-        # Ignore comments.
-        if self.ignore_pattern.search(line):
-            if is_regex_rule:
-                print(f'please add domain manually for ignored regex rule: {origin_line}')
-            return
-
-        line = self.head_filter_pattern.sub('', line)
-        line = self.tail_filter_pattern.sub('', line)
-
-        if not self.domain_pattern.search(line):
-            if is_regex_rule:
-                print(f'please add domain manually for ignored regex rule: {origin_line}')
-            return
-
-        domain = self.wildcard_pattern.search(line).groups()[3]
-        if is_regex_rule:
-            print(f'regex rule {line} -> {domain}')
-        self.domains.add(domain)
-
     def parse(self, data):
         """
         Return False if there are parsing errors.
+
+        :param data: decoded gfwlist content as bytes
         """
-        lines = data.splitlines()
-        if len(lines) == 0:
+        if not data:
             print('gfwlist is empty')
             return False
 
-        if not lines[0].startswith('[AutoProxy'):
+        if not data.startswith(b'[AutoProxy'):
             print('gfwlist is not in AutoProxy format')
             return False
 
-        for line in lines[0:]:
-            # Parse gfwlist line by line.
-            # Add each domain to self.domains.
-            self._parse_line(line)
+        for m in REGEX_RULE_RE.finditer(data):
+            print(f'please add domain manually for ignored regex rule: {m.group().decode()}')
+
+        # Add the domain of each line to self.domains. findall returns the
+        # captured domains directly, so there's no Python level loop here.
+        self.domains.extend(map(bytes.decode, DOMAIN_LINE_RE.findall(data)))
 
     def add_extra_domains(self):
         print('adding google domains')
-        self.domains.update(['google.com', 'google.ad', 'google.ae',
-        'google.com.af', 'google.com.ag', 'google.com.ai', 'google.al',
-        'google.am', 'google.co.ao', 'google.com.ar', 'google.as', 'google.at',
-        'google.com.au', 'google.az', 'google.ba', 'google.com.bd', 'google.be',
-        'google.bf', 'google.bg', 'google.com.bh', 'google.bi', 'google.bj',
-        'google.com.bn', 'google.com.bo', 'google.com.br', 'google.bs',
-        'google.bt', 'google.co.bw', 'google.by', 'google.com.bz', 'google.ca',
-        'google.cd', 'google.cf', 'google.cg', 'google.ch', 'google.ci',
-        'google.co.ck', 'google.cl', 'google.cm', 'google.cn', 'google.com.co',
-        'google.co.cr', 'google.com.cu', 'google.cv', 'google.com.cy',
-        'google.cz', 'google.de', 'google.dj', 'google.dk', 'google.dm',
-        'google.com.do', 'google.dz', 'google.com.ec', 'google.ee',
-        'google.com.eg', 'google.es', 'google.com.et', 'google.fi',
-        'google.com.fj', 'google.fm', 'google.fr', 'google.ga', 'google.ge',
-        'google.gg', 'google.com.gh', 'google.com.gi', 'google.gl', 'google.gm',
-        'google.gp', 'google.gr', 'google.com.gt', 'google.gy', 'google.com.hk',
-        'google.hn', 'google.hr', 'google.ht', 'google.hu', 'google.co.id',
-        'google.ie', 'google.co.il', 'google.im', 'google.co.in', 'google.iq',
-        'google.is', 'google.it', 'google.je', 'google.com.jm', 'google.jo',
-        'google.co.jp', 'google.co.ke', 'google.com.kh', 'google.ki',
-        'google.kg', 'google.co.kr', 'google.com.kw', 'google.kz', 'google.la',
-        'google.com.lb', 'google.li', 'google.lk', 'google.co.ls', 'google.lt',
-        'google.lu', 'google.lv', 'google.com.ly', 'google.co.ma', 'google.md',
-        'google.me', 'google.mg', 'google.mk', 'google.ml', 'google.com.mm',
-        'google.mn', 'google.ms', 'google.com.mt', 'google.mu', 'google.mv',
-        'google.mw', 'google.com.mx', 'google.com.my', 'google.co.mz',
-        'google.com.na', 'google.com.nf', 'google.com.ng', 'google.com.ni',
-        'google.ne', 'google.nl', 'google.no', 'google.com.np', 'google.nr',
-        'google.nu', 'google.co.nz', 'google.com.om', 'google.com.pa',
-        'google.com.pe', 'google.com.pg', 'google.com.ph', 'google.com.pk',
-        'google.pl', 'google.pn', 'google.com.pr', 'google.ps', 'google.pt',
-        'google.com.py', 'google.com.qa', 'google.ro', 'google.ru', 'google.rw',
-        'google.com.sa', 'google.com.sb', 'google.sc', 'google.se',
-        'google.com.sg', 'google.sh', 'google.si', 'google.sk', 'google.com.sl',
-        'google.sn', 'google.so', 'google.sm', 'google.sr', 'google.st',
-        'google.com.sv', 'google.td', 'google.tg', 'google.co.th',
-        'google.com.tj', 'google.tk', 'google.tl', 'google.tm', 'google.tn',
-        'google.to', 'google.com.tr', 'google.tt', 'google.com.tw',
-        'google.co.tz', 'google.com.ua', 'google.co.ug', 'google.co.uk',
-        'google.com.uy', 'google.co.uz', 'google.com.vc', 'google.co.ve',
-        'google.vg', 'google.co.vi', 'google.com.vn', 'google.vu', 'google.ws',
-        'google.rs', 'google.co.za', 'google.co.zm', 'google.co.zw',
-        'google.cat'])
+        self.domains.extend(GOOGLE_TLDS)
 
         print('add blogspot domains')
-        self.domains.update(['blogspot.ca', 'blogspot.co.uk', 'blogspot.com',
-        'blogspot.com.ar', 'blogspot.com.au', 'blogspot.com.br',
-        'blogspot.com.by', 'blogspot.com.co', 'blogspot.com.cy',
-        'blogspot.com.ee', 'blogspot.com.eg', 'blogspot.com.es',
-        'blogspot.com.mt', 'blogspot.com.ng', 'blogspot.com.tr',
-        'blogspot.com.uy', 'blogspot.de', 'blogspot.gr', 'blogspot.in',
-        'blogspot.mx', 'blogspot.ch', 'blogspot.fr', 'blogspot.ie',
-        'blogspot.it', 'blogspot.pt', 'blogspot.ro', 'blogspot.sg',
-        'blogspot.be', 'blogspot.no', 'blogspot.se', 'blogspot.jp',
-        'blogspot.in', 'blogspot.ae', 'blogspot.al', 'blogspot.am',
-        'blogspot.ba', 'blogspot.bg', 'blogspot.ch', 'blogspot.cl',
-        'blogspot.cz', 'blogspot.dk', 'blogspot.fi', 'blogspot.gr',
-        'blogspot.hk', 'blogspot.hr', 'blogspot.hu', 'blogspot.ie',
-        'blogspot.is', 'blogspot.kr', 'blogspot.li', 'blogspot.lt',
-        'blogspot.lu', 'blogspot.md', 'blogspot.mk', 'blogspot.my',
-        'blogspot.nl', 'blogspot.no', 'blogspot.pe', 'blogspot.qa',
-        'blogspot.ro', 'blogspot.ru', 'blogspot.se', 'blogspot.sg',
-        'blogspot.si', 'blogspot.sk', 'blogspot.sn', 'blogspot.tw',
-        'blogspot.ug', 'blogspot.cat'])
+        self.domains.extend(BLOGSPOT_TLDS)
 
         print('add twimg.edgesuite.net')
-        self.domains.add('twimg.edgesuite.net')
+        self.domains.append('twimg.edgesuite.net')
+
+    def _sorted_domains(self):
+        """
+        Return domains sorted by reversed labels, e.g. mail.google.com sorts as
+        com.google.mail. A domain is followed by its duplicates and all its
+        subdomains, which are dropped as they are already covered by the domain.
+        """
+        domains = []
+        last = None
+        for domain in sorted(self.domains, key=lambda d: d.split('.')[::-1]):
+            if last and (domain == last or domain.endswith('.' + last)):
+                continue
+            domains.append(domain)
+            last = domain
+        return domains
 
     def format_adguardhome(self, output):
-        with open(output, 'w') as f:
-            for server in BASE_DNS_SERVER:
-                f.write(f'{server}\n')
-            for domain in self.domains:
-                f.write(f'[/{domain}/]{self.dns_server}\n')
+        # Build the whole file content, encode it once and write it at once.
+        # dns_server is the same for all domains, so the end of one rule and
+        # the start of the next is a constant separator for join.
+        content = ''.join(f'{server}\n' for server in BASE_DNS_SERVER)
+        domains = self._sorted_domains()
+        if domains:
+            suffix = f'/]{self.dns_server}\n'
+            content += '[/' + (suffix + '[/').join(domains) + suffix
+        with open(output, 'wb') as f:
+            f.write(content.encode())
 
             extra = Path('./extra.txt')
             if extra.exists():
-                with open(extra, 'r') as ex:
-                    f.write(ex.read())
+                # Let the kernel copy extra.txt with sendfile where it's
+                # supported, otherwise copy it in blocks.
+                # sendfile may copy less than asked, so loop until the whole
+                # file is sent. It doesn't move ex's position, so seek past
+                # the sent part before falling back.
+                with open(extra, 'rb') as ex:
+                    f.flush()
+                    size = os.fstat(ex.fileno()).st_size
+                    sent = 0
+                    try:
+                        while sent < size:
+                            n = os.sendfile(f.fileno(), ex.fileno(), sent, size - sent)
+                            if n == 0:
+                                break
+                            sent += n
+                    except (AttributeError, OSError):
+                        ex.seek(sent)
+                        shutil.copyfileobj(ex, f, 1 << 16)
 
 
     def format_raw(self, output):
-        with open(output, 'w') as f:
-            for domain in self.domains:
-                f.write(f'{domain}\n')
+        with open(output, 'wb') as f:
+            domains = self._sorted_domains()
+            if domains:
+                f.write(('\n'.join(domains) + '\n').encode())
 
     def run(self, output: str, download: bool, gfwlist_fname: str, format: str):
         """
@@ -234,16 +309,16 @@ class GfwList:
         """
         if download:
             data = self.fetch()
-            data = base64.b64decode(data).decode('utf-8')
+            if not data:
+                return
         elif gfwlist_fname:
-            data = open(gfwlist_fname, 'r').read()
+            data = Path(gfwlist_fname).read_bytes()
         else:
             print(f'either download or gfwlist_fname must be specified')
             return
 
         if download and gfwlist_fname:
-            with open(gfwlist_fname, 'w') as f:
-                f.write(data)
+            Path(gfwlist_fname).write_bytes(data)
 
         self.parse(data)
         self.add_extra_domains()